@@ -1,14 +1,20 @@
+from __future__ import annotations
 import streamlit as st
-import subprocess, sys, json, pathlib, zipfile, io
+import pathlib, zipfile, io, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import backend.extractor as ext
 
 # -----------------------------
-# Folders
+# Folders (created by the extractor at import, independent of cwd)
 # -----------------------------
-OUT_DIR = pathlib.Path(".").resolve()
-MODELS_DIR = OUT_DIR / "models"
-PAGES_DIR = OUT_DIR / "pages"
-for d in (PAGES_DIR, MODELS_DIR):
-    d.mkdir(parents=True, exist_ok=True)
+OUT_DIR = ext.OUT_DIR
+MODELS_DIR = ext.MODELS_DIR
+PAGES_DIR = ext.PAGES_DIR
+
+# Worker threads used by the bulk tabs (extraction is network/LLM bound;
+# Playwright calls are already serialized onto the extractor's browser thread)
+MAX_WORKERS = 4
 
 # -----------------------------
 # Custom CSS
@@ -29,61 +35,120 @@ st.title("📄 CMS JSON Extractor POC")
 # Debug Mode Toggle
 # -----------------------------
 debug_mode = st.checkbox("🛠️ Debug Mode: Show meta tags & snippets", value=False)
+force_refresh = st.checkbox("🔄 Force refresh: ignore cached extraction results", value=False)
+
+# -----------------------------
+# Cached Extractor Calls
+# -----------------------------
+class UncachedResult(Exception):
+    """Raised out of cached_extract so st.cache_data does not keep a degraded result"""
+    def __init__(self, page_obj: dict):
+        super().__init__(page_obj.get("_llm_error", ""))
+        self.page_obj = page_obj
+
+def page_slug(page_obj: dict) -> str:
+    return page_obj.get("page_uid", "page_unknown").replace("page_", "")
+
+def snapshot_files(page_obj: dict) -> dict:
+    """Bytes of the page/model JSON this extraction wrote, keyed by path relative to OUT_DIR"""
+    paths = [PAGES_DIR / f"{page_slug(page_obj)}.json"] + [OUT_DIR / m["path"] for m in page_obj.get("models", [])]
+    return {str(p.relative_to(OUT_DIR)): p.read_bytes() for p in paths}
+
+def restore_files(slug: str, files: dict):
+    """Rewrite a result's files so disk (and the ZIP built from it) match what is shown, dropping stale models"""
+    keep = set()
+    for rel, data in files.items():
+        path = OUT_DIR / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        keep.add(path)
+    model_dir = MODELS_DIR / slug
+    if model_dir.exists():
+        for mf in model_dir.glob("*.json"):
+            if mf not in keep:
+                mf.unlink()
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def cached_extract(source: str, mtime_ns: int | None = None, debug: bool = False, content: bytes | None = None) -> dict:
+    """mtime_ns only keys the cache, so edited local files are re-extracted.
+    The written files travel with the result under "_files", so a cache hit can restore them."""
+    page_obj = ext.build_models_for_page(source, debug=debug, content=content)
+    page_obj["_files"] = snapshot_files(page_obj)
+    if page_obj.get("_llm_error"):
+        raise UncachedResult(page_obj)
+    return page_obj
+
+def extract_source(source: str, mtime_ns: int | None = None, debug: bool = False, content: bytes | None = None) -> dict:
+    """cached_extract, except results built from LLM fallback models are returned but never cached"""
+    try:
+        return cached_extract(source, mtime_ns, debug, content)
+    except UncachedResult as e:
+        return e.page_obj
+
+def source_mtime(source: str):
+    path = pathlib.Path(source)
+    return path.stat().st_mtime_ns if path.exists() else None
 
 # -----------------------------
 # Utility Functions
 # -----------------------------
-def process_source(source: str, label: str = "Processing"):
+def process_source(source: str, label: str = "Processing", content: bytes | None = None):
     st.info(f"{label} {source} ...")
+    if force_refresh:
+        cached_extract.clear()
+        ext.clear_llm_cache()
     try:
-        result = subprocess.run(
-            [sys.executable, "backend/extractor.py", source],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        stdout = result.stdout.decode("utf-8", errors="replace")
-        stderr = result.stderr.decode("utf-8", errors="replace")
-
-        if result.returncode != 0:
-            st.error(f"❌ Extractor failed:\n{stderr}")
-            return None, None, None, None
-
-        # Parse backend JSON output for slug
-        try:
-            page_obj = json.loads(stdout)
-            slug = page_obj.get("page_uid", "page_unknown").replace("page_", "")
-        except Exception:
-            slug = source.strip("/").split("/")[-1].replace(".html", "")
-            page_obj = None
+        page_obj = extract_source(source, None if content else source_mtime(source), debug_mode, content)
+    except Exception as e:
+        st.error(f"❌ Extractor failed: {e}")
+        return None, None, None, None
+    return collect_result(source, page_obj)
 
-        page_file = PAGES_DIR / f"{slug}.json"
+def extract_one(source: str, read_content=None) -> dict:
+    """Worker task; read_content(source) loads uploaded bytes only once the task actually runs"""
+    content = read_content(source) if read_content else None
+    return extract_source(source, None if content else source_mtime(source), debug_mode, content)
 
-        # Initialize fallback JSON
-        if not page_file.exists():
-            dummy = {
-                "page_url": source,
-                "page_uid": f"page_{slug}",
-                "models": [],
-                "metadata": {"title": "N/A", "description": ""}
-            }
-            with open(page_file, "w", encoding="utf-8") as f:
-                json.dump(dummy, f, ensure_ascii=False, indent=2)
-            page_obj = dummy
-        elif page_obj is None:
-            with open(page_file, "r", encoding="utf-8") as f:
-                page_obj = json.load(f)
-
-        # --- Debug info ---
-        meta_info = None
-        snippets_info = None
-        if debug_mode:
+def process_sources_parallel(sources: list, read_content=None):
+    """Run the extractor over sources in worker threads, yielding (idx, source, result) as each finishes"""
+    if force_refresh:
+        cached_extract.clear()
+        ext.clear_llm_cache()
+    # Workers share this session's script context so the st.cache_data lookups behave as on the main thread
+    ex = ThreadPoolExecutor(max_workers=MAX_WORKERS, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx()))
+    try:
+        futures = {
+            ex.submit(extract_one, s, read_content): (idx, s)
+            for idx, s in enumerate(sources, start=1)
+        }
+        for fut in as_completed(futures):
+            idx, source = futures[fut]
             try:
-                import backend.extractor as ext
-                html_content = ext.get_html(source)
-                soup = ext.soupify(html_content)
-                meta_info = ext.extract_meta(soup)
-                snippets_info = ext.extract_snippets(soup)
+                page_obj = fut.result()
             except Exception as e:
-                st.warning(f"⚠️ Could not fetch debug info: {e}")
+                st.error(f"❌ Extractor failed for {source}: {e}")
+                yield idx, source, (None, None, None, None)
+                continue
+            yield idx, source, collect_result(source, page_obj)
+    finally:
+        # A rerun/stop closes this generator mid-batch: drop queued sources and
+        # return immediately instead of waiting for every remaining URL
+        ex.shutdown(wait=False, cancel_futures=True)
+
+def collect_result(source: str, page_obj: dict):
+    try:
+        debug_info = page_obj.pop("_debug", None) or {}
+        llm_error = page_obj.pop("_llm_error", None)
+        if llm_error:
+            st.warning(f"⚠️ LLM unavailable, fallback models used (not cached): {llm_error}")
+        slug = page_slug(page_obj)
+        # On a cache hit nothing was written; another upload with the same slug
+        # (or a deleted pages/ folder) may have changed the files since
+        restore_files(slug, page_obj.pop("_files", {}))
+
+        # --- Debug info (collected by the extractor during the same run) ---
+        meta_info = debug_info.get("meta")
+        snippets_info = debug_info.get("snippets")
 
         return slug, page_obj, meta_info, snippets_info
     except Exception as e:
@@ -106,17 +171,18 @@ def display_json_and_zip(slug: str, page_obj: dict, meta_info=None, snippets_inf
             st.json(model)
 
     zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w") as zf:
+    # JSON compresses well; a low level keeps deflate cheap
+    with zipfile.ZipFile(zip_buffer, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=3) as zf:
         page_file = PAGES_DIR / f"{slug}.json"
-        zf.write(page_file, arcname=page_file.name)
+        zf.writestr(page_file.name, page_file.read_bytes())
         model_dir = MODELS_DIR / slug
         if model_dir.exists():
             for mf in model_dir.glob("*.json"):
-                zf.write(mf, arcname=f"{slug}/{mf.name}")
+                zf.writestr(f"{slug}/{mf.name}", mf.read_bytes())
 
     st.download_button(
         label="⬇️ Download ZIP",
-        data=zip_buffer.getvalue(),
+        data=zip_buffer,
         file_name=f"{slug}.zip",
         mime="application/zip",
         key=f"zip_{slug}"
@@ -150,9 +216,9 @@ with tab_bulk_url:
     if uploaded_file and st.button("⚡ Extract Bulk URLs"):
         urls = [line.strip() for line in uploaded_file.read().decode("utf-8").splitlines() if line.strip()]
         st.info(f"Processing {len(urls)} URLs ...")
-        for idx, url in enumerate(urls, start=1):
+        for idx, url, result in process_sources_parallel(urls):
             st.subheader(f"{idx}. {url}")
-            slug, page_obj, meta_info, snippets_info = process_source(url)
+            slug, page_obj, meta_info, snippets_info = result
             if slug and page_obj:
                 display_json_and_zip(slug, page_obj, meta_info, snippets_info)
 
@@ -163,10 +229,7 @@ with tab_html:
     st.header("📄 Extract JSON from Local HTML File")
     html_file = st.file_uploader("Upload a single HTML file", type=["html"])
     if html_file and st.button("⚡ Extract Single HTML"):
-        path = pathlib.Path(html_file.name)
-        with open(path, "wb") as f:
-            f.write(html_file.getbuffer())
-        slug, page_obj, meta_info, snippets_info = process_source(str(path), label=html_file.name)
+        slug, page_obj, meta_info, snippets_info = process_source(html_file.name, label=html_file.name, content=html_file.getvalue())
         if slug and page_obj:
             display_json_and_zip(slug, page_obj, meta_info, snippets_info)
 
@@ -178,17 +241,17 @@ with tab_bulk_html:
     st.info("Upload multiple HTML files as .zip (one HTML per file)")
     bulk_html_zip = st.file_uploader("Upload .zip containing HTML files", type=["zip"])
     if bulk_html_zip and st.button("⚡ Extract Bulk HTML"):
-        zip_path = pathlib.Path("temp_bulk.zip")
-        with open(zip_path, "wb") as f:
-            f.write(bulk_html_zip.getbuffer())
-        with zipfile.ZipFile(zip_path, "r") as zf:
-            file_list = zf.namelist()
+        # Members are read straight from the upload, one per running worker;
+        # nothing is extracted to disk or decompressed ahead of time
+        with zipfile.ZipFile(bulk_html_zip, "r") as zf:
+            file_list = [name for name in zf.namelist() if not name.endswith("/")]
             st.info(f"Found {len(file_list)} files in ZIP")
-            for html_file in file_list:
-                with zf.open(html_file) as f:
-                    out_file = pathlib.Path(html_file)
-                    out_file.write_bytes(f.read())
-                    st.subheader(f"{html_file}")
-                    slug, page_obj, meta_info, snippets_info = process_source(str(out_file), label=html_file)
-                    if slug and page_obj:
-                        display_json_and_zip(slug, page_obj, meta_info, snippets_info)
+            zip_lock = threading.Lock()
+            def read_member(name: str) -> bytes:
+                with zip_lock, zf.open(name) as f:
+                    return f.read()
+            for _, html_file, result in process_sources_parallel(file_list, read_member):
+                st.subheader(f"{html_file}")
+                slug, page_obj, meta_info, snippets_info = result
+                if slug and page_obj:
+                    display_json_and_zip(slug, page_obj, meta_info, snippets_info)
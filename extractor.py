@@ -2,60 +2,140 @@
 Robust CMS JSON Extractor (URL + HTML)
 - Captures meta + DOM snippets
 - Delegates schema classification to LLM
+  (or builds models directly from OpenGraph meta when it is rich enough)
 - Always creates at least one model per snippet
 - Writes atomic model JSONs and nested page JSON
 """
 
-import sys, json, re, pathlib, io
+import sys, json, re, pathlib, io, functools, hashlib, copy, threading
+from collections import OrderedDict
 from bs4 import BeautifulSoup
 from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 import ollama
+import orjson
+import requests
 from playwright.sync_api import sync_playwright
 
-# Force UTF-8 output
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
-sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
-
 # === Config ===
 USE_LLM = True
 LLM_MODEL = "gemma:2b"
+LLM_HOST = None          # None -> OLLAMA_HOST env var / localhost
+LLM_KEEP_ALIVE = "30m"   # keep the model loaded between pages
+PRETTY_JSON = False      # indent written JSON (debugging only; compact is ~2x smaller)
+HTTP_TIMEOUT = 15        # seconds for the plain-HTTP fast path before Playwright
+META_FAST_PATH = True    # build models from og:title/og:image directly, skipping the LLM
 OUT_DIR = pathlib.Path(__file__).resolve().parent.parent
 PAGES_DIR = OUT_DIR / "pages"
 MODELS_DIR = OUT_DIR / "models"
 
+_CREATED_DIRS = set()
+
+def _ensure_dir(path: pathlib.Path):
+    """mkdir once per process; later calls for the same path are a set lookup.
+    write_json recreates the directory if it is deleted while the server runs."""
+    if path not in _CREATED_DIRS:
+        path.mkdir(parents=True, exist_ok=True)
+        _CREATED_DIRS.add(path)
+
 for d in (PAGES_DIR, MODELS_DIR):
-    d.mkdir(parents=True, exist_ok=True)
+    _ensure_dir(d)
+
+_SLUG_INVALID = re.compile(r'[^a-z0-9]+')
+_SLUG_DASHES = re.compile(r'-+')
+_JSON_DECODER = json.JSONDecoder()
+_PIPE_SUFFIX = re.compile(r"\s+\|\s+[^|]+$")
 
 # === Helpers ===
+@functools.lru_cache(maxsize=4096)
 def slugify(url_or_name: str) -> str:
     """Safe folder/filename for Windows"""
-    slug = re.sub(r'[^a-z0-9]+', '-', url_or_name.strip().lower())
-    slug = re.sub(r'-+', '-', slug)
+    slug = _SLUG_INVALID.sub('-', url_or_name.strip().lower())
+    slug = _SLUG_DASHES.sub('-', slug)
     return slug.strip('-') or "page"
 
-def get_html(source: str) -> str:
-    """Fetch HTML from URL or local file"""
+# === Plain HTTP (fast path for server-rendered pages) ===
+_HTTP = requests.Session()
+_HTTP.headers["User-Agent"] = "Mozilla/5.0 (compatible; cms-json-extractor)"
+
+def _fetch_static(source: str):
+    """GET the page; return its HTML only if it already looks fully rendered, else None"""
+    try:
+        resp = _HTTP.get(source, timeout=HTTP_TIMEOUT, allow_redirects=True)
+        resp.raise_for_status()
+    except requests.RequestException:
+        return None
+    if "charset" not in resp.headers.get("content-type", "").lower():
+        resp.encoding = resp.apparent_encoding
+    html = resp.text
+    lower = html.lower()
+    if len(html) > 2000 and "<title" in lower and "<h1" in lower:
+        return html
+    return None
+
+# === Browser (launched once per engine, reused across sources) ===
+# Playwright's sync API is bound to the thread that started it, while
+# Streamlit runs every rerun on a fresh thread, so all browser work goes
+# through one dedicated thread. The driver closes the browsers on exit.
+_BROWSER_THREAD = ThreadPoolExecutor(max_workers=1, thread_name_prefix="playwright")
+_PW = None
+_CONTEXTS = {}
+
+def _ensure_browser(name: str):
+    """Launch the named engine on first use and return its shared context"""
+    global _PW
+    if _PW is None:
+        _PW = sync_playwright().start()
+    if name not in _CONTEXTS:
+        browser = getattr(_PW, name).launch(headless=True)
+        try:
+            _CONTEXTS[name] = browser.new_context()
+        except Exception:
+            browser.close()
+            raise
+    return _CONTEXTS[name]
+
+def _drop_if_disconnected(name: str):
+    """Forget a crashed browser so the next page relaunches it instead of failing forever"""
+    ctx = _CONTEXTS.get(name)
+    if ctx is not None and not (ctx.browser and ctx.browser.is_connected()):
+        del _CONTEXTS[name]
+
+def _render_page(source: str) -> str:
+    errors = []
+    for name in ("firefox", "chromium"):
+        page = None
+        try:
+            page = _ensure_browser(name).new_page()
+            page.goto(source, timeout=180000, wait_until="load")
+            page.wait_for_load_state("networkidle", timeout=60000)
+            return page.content()
+        except Exception as e:
+            errors.append(f"{name}: {e}")
+            _drop_if_disconnected(name)
+        finally:
+            if page is not None:
+                try: page.close()
+                except Exception: pass
+    raise RuntimeError(f"Could not fetch HTML from {source} ({'; '.join(errors)})")
+
+def get_html(source) -> str:
+    """Fetch HTML from URL or local file; bytes and open (text or binary) file objects are read as-is"""
     from pathlib import Path
+    if hasattr(source, "read"):
+        data = source.read()
+        return data.decode("utf-8") if isinstance(data, bytes) else data
+    if isinstance(source, bytes):
+        return source.decode("utf-8")
     if Path(source).exists():
         return Path(source).read_text(encoding="utf-8")
-
-    with sync_playwright() as p:
-        for browser_type in [p.firefox, p.chromium]:
-            try:
-                browser = browser_type.launch(headless=True)
-                page = browser.new_page()
-                page.goto(source, timeout=180000, wait_until="load")
-                page.wait_for_load_state("networkidle", timeout=60000)
-                html = page.content()
-                browser.close()
-                return html
-            except:
-                browser.close()
-                continue
-    raise RuntimeError(f"Could not fetch HTML from {source}")
+    html = _fetch_static(source)
+    if html is not None:
+        return html
+    return _BROWSER_THREAD.submit(_render_page, source).result()
 
 def soupify(html: str):
-    return BeautifulSoup(html, "html.parser")
+    return BeautifulSoup(html, "lxml")
 
 def extract_meta(soup):
     meta = {}
@@ -70,35 +150,51 @@ def extract_meta(soup):
         if can and can.get("href"): meta.setdefault("canonical", can["href"].strip())
     return meta
 
+# Snippet sources, in the order they are emitted
+BLOCK_SELECTORS = ["header",".hero",".banner","main","article","section",".card",".teaser",".tile"]
+HEADING_TAGS = ["h1","h2","h3","h4"]
+PARAGRAPH_CONTAINERS = ["main","article","section"]
+_SNIPPET_TAGS = frozenset(s for s in BLOCK_SELECTORS + HEADING_TAGS if not s.startswith("."))
+_SNIPPET_CLASSES = frozenset(s[1:] for s in BLOCK_SELECTORS if s.startswith("."))
+_SNIPPET_KINDS = len(_SNIPPET_TAGS) + len(_SNIPPET_CLASSES)
+
+def _classify(el):
+    """Selectors ("h1", ".card", ...) that el matches; one element can match several"""
+    kinds = [el.name] if el.name in _SNIPPET_TAGS else []
+    kinds += ["."+c for c in el.get("class") or () if c in _SNIPPET_CLASSES]
+    return kinds
+
 def extract_snippets(soup, max_blocks=15):
-    snippets = []
+    # Single depth-first walk: remember the first element of each kind,
+    # same as select_one per selector but without re-walking the tree
+    first = {}
+    for el in soup.descendants:
+        if el.name is None: continue
+        for kind in _classify(el): first.setdefault(kind, el)
+        if len(first) == _SNIPPET_KINDS: break
+    # Deduplicate & limit: keyed by a digest of selector + full text, in insertion order
+    snippets = {}
+    def add(sel, text):
+        if text and len(snippets) < max_blocks:
+            key = hashlib.blake2b(f"{sel}\0{text}".encode(), digest_size=8).digest()
+            snippets.setdefault(key, {"selector": sel, "text": text})
     # Common blocks
-    for sel in ["header",".hero",".banner","main","article","section",".card",".teaser",".tile"]:
-        el = soup.select_one(sel)
+    for sel in BLOCK_SELECTORS:
+        el = first.get(sel)
         if el:
-            text = el.get_text(" ", strip=True)
-            if text:
-                snippets.append({"selector": sel, "text": text[:2000]})
+            add(sel, el.get_text(" ", strip=True)[:2000])
     # Headings
-    for h in ["h1","h2","h3","h4"]:
-        el = soup.select_one(h)
-        if el and el.get_text(strip=True):
-            snippets.append({"selector": h, "text": el.get_text(" ",strip=True)[:600]})
+    for h in HEADING_TAGS:
+        el = first.get(h)
+        if el:
+            add(h, el.get_text(" ", strip=True)[:600])
     # Paragraphs
-    for main_sel in ["main","article","section"]:
-        main = soup.select_one(main_sel)
-        if main:
+    for main_sel in PARAGRAPH_CONTAINERS:
+        main = first.get(main_sel)
+        if main and len(snippets) < max_blocks:
             for p in main.find_all("p", limit=5):
-                text = p.get_text(" ", strip=True)
-                if text:
-                    snippets.append({"selector": f"{main_sel} > p", "text": text[:800]})
-    # Deduplicate & limit
-    unique, seen = [], set()
-    for s in snippets:
-        key = s.get("selector")+":"+s.get("text","")[:80]
-        if key not in seen: unique.append(s); seen.add(key)
-        if len(unique) >= max_blocks: break
-    return unique
+                add(f"{main_sel} > p", p.get_text(" ", strip=True)[:800])
+    return list(snippets.values())
 
 # --- Prompt template ---
 PROMPT_TEMPLATE = """
@@ -132,33 +228,125 @@ Do not add comments, explanations, or markdown.
 Make sure it parses with json.loads in Python without errors.
 """
 
+def _salvage_truncated(raw: str):
+    """Parse the longest prefix of a cut-off object by closing the brackets still open there"""
+    stack, cuts, in_str, esc = [], [], False, False
+    for i, ch in enumerate(raw):
+        if in_str:
+            if esc: esc = False
+            elif ch == "\\": esc = True
+            elif ch == '"': in_str = False
+        elif ch == '"': in_str = True
+        elif ch in "{[": stack.append("}" if ch == "{" else "]")
+        elif ch in "}]" and stack:
+            stack.pop()
+            if stack: cuts.append((i, "".join(reversed(stack))))
+    for i, closers in reversed(cuts):
+        try: return json.loads(raw[:i+1] + closers)
+        except ValueError: continue
+    return None
+
 def safe_json_parse(raw: str):
-    if raw.startswith("```"): raw = raw.strip("`\n"); 
+    if raw.startswith("```"): raw = raw.strip("`\n")
     if raw.lower().startswith("json"): raw = raw[4:].strip()
-    try: return json.loads(raw)
-    except: pass
-    match = re.search(r"\{.*\}", raw, re.S)
-    if match:
-        try: return json.loads(match.group(0))
-        except: pass
+    try: return orjson.loads(raw)
+    except orjson.JSONDecodeError: pass
+    start = raw.find("{")
+    if start != -1:
+        raw = raw[start:]
+        # First complete object only, ignoring any chatter after it
+        try: return _JSON_DECODER.raw_decode(raw)[0]
+        except ValueError: pass
     try:
-        import json5
+        import json5  # lenient but slow; only reached for malformed output
         return json5.loads(raw)
-    except: raise RuntimeError(f"❌ Could not parse JSON:\n{raw[:500]}")
+    except Exception: pass
+    salvaged = _salvage_truncated(raw) if start != -1 else None
+    if salvaged is not None: return salvaged
+    raise RuntimeError(f"❌ Could not parse JSON:\n{raw[:500]}")
+
+class _ObjectTracker:
+    """Follows brace depth across streamed chunks to spot where the top-level JSON object closes.
+    String state is tracked from the first character, so braces quoted in a preamble are ignored."""
+    def __init__(self):
+        self.depth, self.started, self.in_str, self.esc = 0, False, False, False
+
+    def feed(self, text: str) -> bool:
+        for ch in text:
+            if self.in_str:
+                if self.esc: self.esc = False
+                elif ch == "\\": self.esc = True
+                elif ch == '"': self.in_str = False
+            elif ch == '"': self.in_str = True
+            elif ch == "{": self.depth += 1; self.started = True
+            elif ch == "}" and self.started:
+                self.depth -= 1
+                if self.depth == 0: return True
+        return False
+
+# One client (and HTTP connection pool) for every call
+_CLIENT = ollama.Client(host=LLM_HOST)
+
+# Parsed replies keyed by payload; temperature=0 makes them deterministic, but only
+# complete, successfully parsed replies are kept (see call_llm)
+_LLM_CACHE = OrderedDict()
+_LLM_CACHE_SIZE = 256
+_LLM_CACHE_LOCK = threading.Lock()
+
+def clear_llm_cache():
+    """Forget memoized LLM replies (the app's Force refresh calls this)"""
+    with _LLM_CACHE_LOCK:
+        _LLM_CACHE.clear()
+
+def _cached_reply(payload: str):
+    with _LLM_CACHE_LOCK:
+        if payload not in _LLM_CACHE: return None
+        _LLM_CACHE.move_to_end(payload)
+        return copy.deepcopy(_LLM_CACHE[payload])
+
+def _remember_reply(payload: str, parsed: dict):
+    with _LLM_CACHE_LOCK:
+        _LLM_CACHE[payload] = copy.deepcopy(parsed)
+        _LLM_CACHE.move_to_end(payload)
+        while len(_LLM_CACHE) > _LLM_CACHE_SIZE: _LLM_CACHE.popitem(last=False)
+
+def _chat(payload: str):
+    """Stream the completion and stop generating once the top-level object is complete.
+    Returns (text, complete); complete is False if the stream ended before the object closed."""
+    stream = _CLIENT.chat(
+        model=LLM_MODEL,
+        messages=[{"role":"system","content":PROMPT_TEMPLATE},
+                  {"role":"user","content":payload}],
+        stream=True,
+        keep_alive=LLM_KEEP_ALIVE,
+        options={"num_ctx": 4096, "temperature": 0}
+    )
+    parts, tracker, complete = [], _ObjectTracker(), False
+    try:
+        for chunk in stream:
+            text = chunk["message"]["content"]
+            parts.append(text)
+            if tracker.feed(text):
+                complete = True
+                break
+    finally:
+        stream.close()  # drops the HTTP stream, which aborts generation server-side
+    return "".join(parts), complete
 
 def call_llm(meta_dict: dict, snippets: list, page_url: str) -> dict:
     if not USE_LLM: raise RuntimeError("LLM disabled")
     data = {"meta": meta_dict, "snippets": snippets, "page_url": page_url}
+    payload = json.dumps(data, ensure_ascii=False)
     try:
-        resp = ollama.chat(
-            model=LLM_MODEL,
-            messages=[{"role":"system","content":PROMPT_TEMPLATE},
-                      {"role":"user","content":json.dumps(data, ensure_ascii=False)}]
-        )
-        parsed = safe_json_parse(resp["message"]["content"].strip())
+        parsed = _cached_reply(payload)
+        if parsed is None:
+            raw, complete = _chat(payload)
+            parsed = safe_json_parse(raw.strip())
+            if complete and isinstance(parsed, dict) and parsed.get("models"):
+                _remember_reply(payload, parsed)
     except Exception as e:
         print(f"⚠️ LLM call failed: {e}, using fallback models")
-        parsed = {"page":{"page_url":page_url,"page_title":meta_dict.get("title","N/A")}, "models":[]}
+        parsed = {"page":{"page_url":page_url,"page_title":meta_dict.get("title","N/A")}, "models":[], "llm_error": str(e)}
 
     # Ensure at least one model per snippet
     if "models" not in parsed or not parsed["models"]:
@@ -175,16 +363,75 @@ def call_llm(meta_dict: dict, snippets: list, page_url: str) -> dict:
             })
     return parsed
 
+def _clean_headline(text: str, site_name: str = "") -> str:
+    """Drop a brand suffix: " <sep> og:site_name" when the site name is known, else only a " | Brand" segment"""
+    if site_name:
+        return re.sub(rf"\s+[|\u2013\u2014-]\s+{re.escape(site_name)}\s*$", "", text, flags=re.I).strip()
+    return _PIPE_SUFFIX.sub("", text).strip()
+
+def _summarize(text: str, limit: int = 160) -> str:
+    """Cut at the last word boundary within limit"""
+    if len(text) <= limit: return text
+    return text[:limit].rsplit(" ", 1)[0].rstrip(" ,.;:")
+
+def synthesize_models_from_meta(meta: dict, snippets: list, page_url: str) -> dict:
+    """Deterministic counterpart of call_llm for pages with rich OpenGraph meta.
+    Same output schema as PROMPT_TEMPLATE: banner from og:*, headline from h1, teasers from cards."""
+    first = {}
+    for s in snippets: first.setdefault(s["selector"], s["text"])
+    title = _clean_headline(meta.get("og:title") or meta.get("title",""), meta.get("og:site_name",""))
+    h1 = first.get("h1","") or title
+    models = [{
+        "type": "banner",
+        "fields": {
+            "Title": title,
+            "url": meta.get("og:image",""),
+            "alt": meta.get("og:image:alt") or title,
+            "width": meta.get("og:image:width",""),
+            "height": meta.get("og:image:height",""),
+            "Headline": h1,
+            "Byline": meta.get("author",""),
+            "Description": _summarize(meta.get("og:description") or meta.get("description",""))
+        }
+    }]
+    if h1:
+        models.append({"type": "headline", "fields": {"headline_text": h1, "color": "black", "content_type_uid": "headline"}})
+    for idx, sel in enumerate((s for s in (".card",".teaser",".tile") if s in first), start=1):
+        text = first[sel]
+        models.append({
+            "type": "teaser",
+            "fields": {
+                "title": _summarize(text, 60),
+                "description": _summarize(text),
+                "image": "",
+                "alt_text": "",
+                "display_type": "compact",
+                "uid": f"{slugify(page_url)}-teaser-{idx}"
+            }
+        })
+    return {"page": {"page_url": page_url, "page_title": title}, "models": models}
+
+def write_json(obj, path):
+    """Serialize to UTF-8 bytes in one go and hand them to a single write()"""
+    path = pathlib.Path(path)
+    data = orjson.dumps(obj, option=orjson.OPT_INDENT_2 if PRETTY_JSON else 0)
+    try:
+        path.write_bytes(data)
+    except FileNotFoundError:
+        # Output folder was removed since _ensure_dir created it
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
 def write_models_to_files(models_obj, slug):
     page_dir = MODELS_DIR / slug
-    page_dir.mkdir(parents=True, exist_ok=True)
+    _ensure_dir(page_dir)
     written = []
     counters = {}
     for m in models_obj.get("models", []):
         t = m.get("type","model")
         counters.setdefault(t,0); counters[t]+=1
         fname = f"{t}_{counters[t]:03d}.json"; fpath = page_dir / fname
-        with open(fpath,"w",encoding="utf-8") as fh: json.dump(m.get("fields",{}), fh, ensure_ascii=False, indent=2)
+        write_json(m.get("fields",{}), fpath)
         written.append({"type":t,"path":str(fpath.relative_to(OUT_DIR))})
     page_json = {
         "page_url": models_obj.get("page",{}).get("page_url",""),
@@ -193,32 +440,49 @@ def write_models_to_files(models_obj, slug):
         "metadata": {"title": models_obj.get("page",{}).get("page_title","N/A"),"description":""}
     }
     page_file = PAGES_DIR / f"{slug}.json"
-    with open(page_file,"w",encoding="utf-8") as fh: json.dump(page_json, fh, ensure_ascii=False, indent=2)
+    write_json(page_json, page_file)
     return page_json
 
-def build_models_for_page(source: str):
+def build_models_for_page(source: str, debug: bool = False, content=None):
+    """debug=True attaches the extracted meta/snippets under "_debug" (not written to disk).
+    content (bytes or file object) is used as the page HTML instead of fetching source.
+    "_llm_error" (also not written) is set when the LLM failed and fallback models were used."""
     slug = slugify(source)
-    html = get_html(source)
+    html = get_html(source if content is None else content)
+    meta, snippets = {}, []
     if not html.strip():
         dummy = {"page_url": source, "page_uid": f"page_{slug}", "models": [], "metadata":{"title":"N/A","description":""}}
         page_file = PAGES_DIR / f"{slug}.json"
-        with open(page_file,"w",encoding="utf-8") as fh: json.dump(dummy, fh, ensure_ascii=False, indent=2)
-        return dummy
-    soup = soupify(html)
-    meta = extract_meta(soup)
-    snippets = extract_snippets(soup,max_blocks=15)
-    if not meta and not snippets:
-        dummy = {"page_url": source, "page_uid": f"page_{slug}", "models": [], "metadata":{"title":"N/A","description":""}}
-        return write_models_to_files(dummy, slug)
-    try:
-        models_obj = call_llm(meta,snippets,source)
-    except Exception as e:
-        print(f"⚠️ LLM failed for {source}: {e}, creating dummy JSON")
-        models_obj = {"page":{"page_url":source,"page_title":"N/A"},"models":[]}
-    return write_models_to_files(models_obj, slug)
+        write_json(dummy, page_file)
+        page_json = dummy
+    else:
+        soup = soupify(html)
+        meta = extract_meta(soup)
+        snippets = extract_snippets(soup,max_blocks=15)
+        if not meta and not snippets:
+            dummy = {"page_url": source, "page_uid": f"page_{slug}", "models": [], "metadata":{"title":"N/A","description":""}}
+            page_json = write_models_to_files(dummy, slug)
+        elif META_FAST_PATH and meta.get("og:image") and meta.get("og:title"):
+            page_json = write_models_to_files(synthesize_models_from_meta(meta,snippets,source), slug)
+        else:
+            try:
+                models_obj = call_llm(meta,snippets,source)
+            except Exception as e:
+                print(f"⚠️ LLM failed for {source}: {e}, creating dummy JSON")
+                models_obj = {"page":{"page_url":source,"page_title":"N/A"},"models":[]}
+                if USE_LLM: models_obj["llm_error"] = str(e)
+            page_json = write_models_to_files(models_obj, slug)
+            if models_obj.get("llm_error"):
+                page_json["_llm_error"] = models_obj["llm_error"]
+    if debug:
+        page_json["_debug"] = {"meta": meta, "snippets": snippets}
+    return page_json
 
 # --- CLI ---
 if __name__ == "__main__":
+    # Force UTF-8 output
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
     sources = [a for a in sys.argv[1:] if a != "--local"]
     for s in sources:
         print(f"Processing: {s}")